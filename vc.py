@@ -12,8 +12,16 @@ import os
 import time
 import pickle
 import getopt
+import shlex
 from shutil import rmtree
 import zlib
+import hashlib
+import multiprocessing
+import mimetypes
+import urllib
+import cgi
+import BaseHTTPServer
+from collections import OrderedDict
 
 __version__ = '0.5.5'
 __author__ = 'Szymon Wrozynski (c) 2008-2011'
@@ -26,11 +34,15 @@ __all__ = (
     'BranchExistsError',
     'NotDirectoryError',
     'BadDataError',
+    'BadPolicyError',
+    'BadRangeError',
     'File',
     'Directory',
     'Revision',
     'Branch',
+    'RetentionPolicy',
     'Repository',
+    'BlobCache',
     '__version__',
     '__author__',
     '__modelversion__'
@@ -66,7 +78,70 @@ class BadDataError(Exception):
         self.data = data
 
 
+class BadPolicyError(Exception):
+    def __init__(self, text):
+        self.text = text
+
+
+class BadRangeError(Exception):
+    def __init__(self, first, last):
+        self.first = first
+        self.last = last
+
+
+def _checksum(data):
+    return hashlib.sha1(data).hexdigest()
+
+def _check_blob(blob):
+    data, checksum = blob
+    try:
+        data = zlib.decompress(data)
+    except zlib.error, e:
+        return str(e)
+    if checksum and _checksum(data) != checksum:
+        return 'checksum mismatch'
+    return None
+
+
+class BlobCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+    
+    def get(self, blob):
+        key = id(blob) # the entry holds the blob, so the id is not reused
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        data = zlib.decompress(blob)
+        if len(data) < self.maxsize:
+            self._entries[key] = (blob, data)
+            self.size += len(data)
+            self._shrink()
+        return data
+    
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        self._shrink()
+    
+    def _shrink(self):
+        while self.size > self.maxsize:
+            entry = self._entries.popitem(last=False)[1]
+            self.size -= len(entry[1])
+
+
+blob_cache = BlobCache(32 * 1024 ** 2)
+
+
 class File(object):
+    checksum = None
+    
     def __init__(self, name, prevfile, dr):
         self._data = None
         self.name = name
@@ -76,17 +151,18 @@ class File(object):
     
     def _getdata(self):
         if self._data is not None:
-            return zlib.decompress(self._data)
+            return blob_cache.get(self._data)
         else:
             return None
     
     def _setdata(self, data):
         self._data = zlib.compress(data, zlib.Z_BEST_COMPRESSION)
+        self.checksum = _checksum(data)
         
     data = property(_getdata, _setdata)
         
     def __eq__(self, other):
-        return self.data == other.data \
+        return (self._data is other._data or self.data == other.data) \
                 and self.name == other.name \
                 and self.path() == other.path()
     
@@ -108,12 +184,18 @@ class File(object):
         f.close()
         if self.prevfile and data == self.prevfile.data:
             self._data = self.prevfile._data
+            self.checksum = self.prevfile.checksum or _checksum(data)
         else:
             self.data = data
         if callback: callback(self, path)
     
     def is_changed(self):
         return self.prevfile is None or self._data is not self.prevfile._data
+    
+    def etag(self):
+        if self.checksum:
+            return self.checksum
+        return '%08x' % (zlib.crc32(self._data) & 0xffffffff)
         
     def visit(self, accept):
         accept(self)
@@ -181,6 +263,21 @@ class Directory(object):
                 self.files[entry] = File(entry, prevfile, self)
                 self.files[entry].commit(path, callback)
         if callback: callback(self, path)        
+    
+    def relink(self, prevdir):
+        self.prevdir = prevdir
+        for name in self.files:
+            if prevdir:
+                prevfile = prevdir.files.get(name)
+            else:
+                prevfile = None
+            self.files[name].prevfile = prevfile
+        for name in self.dirs:
+            if prevdir:
+                subdir = prevdir.dirs.get(name)
+            else:
+                subdir = None
+            self.dirs[name].relink(subdir)
         
     def visit(self, accept):
         accept(self)
@@ -192,8 +289,9 @@ class Directory(object):
     def datasize(self):
         filessize = 0
         for key in self.files:
-            if self.files[key].data:
-                filessize += len(self.files[key].data)
+            data = self.files[key].data
+            if data:
+                filessize += len(data)
         for key in self.dirs:
             if self.dirs[key]:
                 filessize += self.dirs[key].datasize()
@@ -223,6 +321,13 @@ class Revision(object):
         self.root.update(parts[0], callback)
         if callback: callback(self, path)
     
+    def relink(self, prev):
+        self.prev = prev
+        if prev:
+            self.root.relink(prev.root)
+        else:
+            self.root.relink(None)
+    
     def visit(self, accept):
         accept(self)
         self.root.visit(accept)
@@ -234,7 +339,72 @@ class Revision(object):
         return self.root.datasize()
 
 
+class RetentionPolicy(object):
+    PERIODS = ('all', 'hourly', 'daily', 'weekly', 'monthly', 'yearly')
+    UNITS = {'h': 3600, 'd': 86400, 'w': 604800, 'm': 2592000, 'y': 31536000}
+    
+    def __init__(self, rules):
+        self.rules = rules
+    
+    def __str__(self):
+        parts = []
+        for period, span in self.rules:
+            if span:
+                parts.append('%s:%s' % (period, span))
+            else:
+                parts.append(period)
+        return ','.join(parts)
+    
+    @classmethod
+    def parse(cls, text):
+        rules = []
+        for part in text.split(','):
+            fields = part.strip().split(':')
+            if len(fields) > 2 or fields[0] not in cls.PERIODS:
+                raise BadPolicyError(text)
+            if len(fields) == 2:
+                span = fields[1].strip()
+                if not span[:-1].isdigit() or span[-1:] not in cls.UNITS:
+                    raise BadPolicyError(text)
+            else:
+                span = None
+            rules.append((fields[0], span))
+        return cls(rules)
+    
+    def _seconds(self, span):
+        return int(span[:-1]) * RetentionPolicy.UNITS[span[-1]]
+    
+    def _bucket(self, period, rev):
+        tm = time.localtime(rev.time)
+        if period == 'all':
+            return rev.num
+        elif period == 'hourly':
+            return tm[:4]
+        elif period == 'daily':
+            return tm[:3]
+        elif period == 'weekly':
+            return time.strftime('%Y-%W', tm)
+        elif period == 'monthly':
+            return tm[:2]
+        else:
+            return tm[:1]
+    
+    def keep(self, revisions, now=None):
+        if now is None: now = time.time()
+        newest = {}
+        for rev in revisions:
+            for i, (period, span) in enumerate(self.rules):
+                if span and now - rev.time > self._seconds(span):
+                    continue
+                newest[(i, self._bucket(period, rev))] = rev
+        kept = set(newest.values())
+        if revisions: kept.add(revisions[-1]) # the latest one always stays
+        return [rev for rev in revisions if rev in kept]
+
+
 class Branch(object):
+    policy = None
+    
     def __init__(self, name, path):
         self.revisions = []
         self.name = name
@@ -273,6 +443,35 @@ class Branch(object):
     def has_revision(self, num):
         return num in range(-len(self.revisions), len(self.revisions))
 
+    def prune(self, policy=None):
+        if policy is None: policy = self.policy
+        if policy is None: return 0
+        return self._retain(policy.keep(self.revisions))
+    
+    def squash(self, first, last):
+        for num in (first, last):
+            if not self.has_revision(num):
+                raise NoSuchRevisionError(num)
+        first %= len(self.revisions)
+        last %= len(self.revisions)
+        if first >= last:
+            raise BadRangeError(first, last)
+        v = self.revisions[last]
+        descs = [sv.desc for sv in self.revisions[first:last + 1] if sv.desc]
+        v.desc = '; '.join(descs) or None
+        self._retain(self.revisions[:first] + self.revisions[last:])
+        return v
+    
+    def _retain(self, kept):
+        removed = len(self.revisions) - len(kept)
+        prev = None
+        for num, v in enumerate(kept):
+            v.num = num
+            if v.prev is not prev: v.relink(prev)
+            prev = v
+        self.revisions = kept
+        return removed
+
     def visit(self, accept):
         accept(self)
         for v in self.revisions:
@@ -334,6 +533,40 @@ class Repository(object):
         
     defbranch = property(_get_defbranch, _set_defbranch)
     
+    def verify(self, jobs=None):
+        blobs = []
+        places = {}
+        for bname in self.branches:
+            for v in self.branches[bname].revisions:
+                def accept(sender, bname=bname, num=v.num):
+                    if not isinstance(sender, File) or sender._data is None:
+                        return
+                    key = (id(sender._data), sender.checksum)
+                    if key not in places:
+                        places[key] = []
+                        blobs.append((key, (sender._data, sender.checksum)))
+                    places[key].append((bname, num, sender.path()))
+                v.visit(accept)
+        if jobs is None: jobs = multiprocessing.cpu_count()
+        tasks = [blob for key, blob in blobs]
+        if jobs > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                chunk = max(1, len(tasks) // (jobs * 4))
+                results = pool.map(_check_blob, tasks, chunk)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_check_blob, tasks)
+        damaged = []
+        for (key, blob), error in zip(blobs, results):
+            if error:
+                for bname, num, path in places[key]:
+                    damaged.append((bname, num, path, error))
+        damaged.sort()
+        return len(blobs), damaged
+    
     def save(self, name, path=os.getcwd()):
         if not name.endswith(Repository.EXT): name += Repository.EXT
         f = open(os.path.join(path, name), 'wb')
@@ -363,6 +596,9 @@ class Usage(Exception):
         self.msg = msg
 
 
+_session = None # loaded repositories while in the shell or batch mode
+
+
 def _check_repname():
     if not repname:
         raise Usage('provide the repository name or create a new one')
@@ -389,9 +625,12 @@ def _check_ver(branch, num):
         raise Usage('branch "%s" does not have a revision no %d' \
                 % (branch.name, num))
                 
+def _format_time(t):
+    return '%d-%d-%d, %d:%d:%d' % time.localtime(t)[:-3]
+
 def _list_print(sender, vonly=False):
     if isinstance(sender, Revision):
-        t = '%d-%d-%d, %d:%d:%d' % time.localtime(sender.time)[:-3]
+        t = _format_time(sender.time)
         if vonly:
             print '%d\t%s\t%d\t%s' \
                     % (sender.num, t, sender.datasize(), sender.desc)
@@ -409,13 +648,43 @@ def _list_print(sender, vonly=False):
 def _vonly_print(sender):
     _list_print(sender, True)
     
-def _parse_num(text):
+def _parse_num(text, what='revision number'):
     try:
         return int(text)
     except:
-        raise Usage('revision number must be an integer')
+        raise Usage('%s must be an integer' % what)
 
 def _load_repo(path):
+    if _session is None:
+        return _read_repo(path)
+    key = (path, repname)
+    if key not in _session:
+        _session[key] = [_read_repo(path), False, True]
+    _session[key][2] = True
+    return _session[key][0]
+
+def _save_repo(repo, path):
+    if _session is None:
+        repo.save(repname, path)
+    else:
+        _session[(path, repname)] = [repo, True, True] # see _flush_session
+
+def _flush_session():
+    for (path, name), entry in _session.items():
+        if entry[1]:
+            entry[0].save(name, path)
+            entry[1] = False
+
+def _discard_touched():
+    # a failed command may leave a repository half changed in memory
+    for key, entry in _session.items():
+        if entry[2]:
+            del _session[key]
+            if entry[1]:
+                print >> sys.stderr, \
+                        'Unsaved changes of repository "%s" discarded.' % key[1]
+
+def _read_repo(path):
     try:
         return Repository.load(repname, path)
     except IOError, e:
@@ -456,7 +725,13 @@ def c_commit(args, path):
         if repo.commit(desc, branchname, _callback):
             print 'Revision commited to the branch "%s" of repository "%s".' \
                     % (branchname, repname)
-            repo.save(repname, path)
+            b = repo.branches[branchname]
+            if b.policy:
+                removed = b.prune()
+                if removed:
+                    print '%d revision(s) pruned (policy: %s).' \
+                            % (removed, b.policy)
+            _save_repo(repo, path)
         else:
             print 'Nothing changed. Commit aborted.'
     except NotDirectoryError, e:
@@ -528,7 +803,7 @@ def c_new(args, path):
             repo = Repository(args[0], branchname)
             repo.commit(None, branchname, _callback)
             _check_branchname(repo)
-            repo.save(repname, path)
+            _save_repo(repo, path)
             print 'Repository "%s" has been created and saved.' % repname 
         except NotDirectoryError, e:
             _process_nde(e)
@@ -544,7 +819,7 @@ def c_new(args, path):
                 defbname = repo.defbranch
             repo.add_branch(branchname, monipath)
             repo.commit(None, branchname, _callback)
-            repo.save(repname, path)
+            _save_repo(repo, path)
             print 'Branch "%s" has been created and saved.' % branchname
             if defbname:
                 pathmsg = ' from the default branch ("%s").' % defbname
@@ -567,7 +842,7 @@ def c_del(args, path):
     if args[0] == repo.defbranch:
         raise Usage('you cannot delete the default branch')
     del(repo.branches[args[0]])
-    repo.save(repname, path)
+    _save_repo(repo, path)
     print 'Branch "%s" deleted.' % args[0]
 
 def c_ren(args, path):
@@ -583,7 +858,7 @@ def c_ren(args, path):
     repo.branches[args[0]] = b
     if has_default:
         repo.defbranch = args[0]
-    repo.save(repname, path)
+    _save_repo(repo, path)
     print 'Branch "%s" renamed to "%s".' % (branchname, args[0])
     
 def c_def(args, path):
@@ -594,7 +869,7 @@ def c_def(args, path):
     if not repo.has_branch(args[0]):
         raise Usage('there is no branch named "%s"' % args[0])
     repo.defbranch = args[0]
-    repo.save(repname, path)
+    _save_repo(repo, path)
     print 'Default branch set to "%s".' % args[0]
         
 def c_path(args, path): 
@@ -604,7 +879,7 @@ def c_path(args, path):
     repo = _load_repo(path)
     _check_branchname(repo) 
     repo.branches[branchname].path = args[0]
-    repo.save(repname, path)
+    _save_repo(repo, path)
     print 'The path of branch "%s" changed successfully.' % branchname
 
 def c_desc(args, path):
@@ -617,11 +892,360 @@ def c_desc(args, path):
     b = repo.branches[branchname]
     _check_ver(b, num)
     b.revisions[num].desc = args[1]
-    repo.save(repname, path)
+    _save_repo(repo, path)
     print 'Description of revision %d of branch "%s" changed to:' \
             % (num, branchname)
     print args[1]
 
+def c_fsck(args, path):
+    _check_repname()
+    if len(args) > 1:
+        raise Usage('provide at most 1 number of workers')
+    if len(args) > 0:
+        jobs = _parse_num(args[0], 'number of workers')
+        if jobs < 1:
+            raise Usage('number of workers must be positive')
+    else:
+        jobs = None
+    repo = _load_repo(path)
+    count, damaged = repo.verify(jobs)
+    for bname, num, fpath, error in damaged:
+        print 'Damaged: branch "%s", revision %d, %s (%s)' \
+                % (bname, num, fpath, error)
+    if damaged:
+        print >> sys.stderr, '%d damaged file(s) found in repository "%s".' \
+                % (len(damaged), repname)
+        return 1
+    print 'Repository "%s" verified, %d blob(s) are consistent.' \
+            % (repname, count)
+
+def _parse_size(text):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    mult = units.get(text[-1:].upper(), 1)
+    if mult > 1: text = text[:-1]
+    if not text.isdigit():
+        raise Usage('size must be a number optionally followed by K, M or G')
+    return int(text) * mult
+
+def _parse_range(header, size):
+    if not header.startswith('bytes=') or ',' in header:
+        return None # multiple ranges are served as a whole
+    first, sep, last = header[6:].strip().partition('-')
+    if not sep or not (first + last).isdigit():
+        return None
+    if first:
+        start = int(first)
+        if last:
+            end = min(int(last), size - 1)
+            if int(last) < start: return None
+        else:
+            end = size - 1
+    else:
+        start = max(size - int(last), 0)
+        end = size - 1
+        if int(last) == 0: start = size
+    if start >= size:
+        raise ValueError(header)
+    return start, end
+
+
+class _RepoRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_version = 'Vercont/' + __version__
+    
+    def do_HEAD(self):
+        self._respond(False)
+    
+    def do_GET(self):
+        self._respond(True)
+    
+    def _respond(self, body):
+        self.send_body = body
+        parts = [urllib.unquote(p) for p in self.path.split('?')[0].split('/')]
+        isdir = parts[-1] == ''
+        parts = [p for p in parts if p]
+        repo = self.server.repo
+        if not parts:
+            return self._list_branches(repo)
+        if not repo.has_branch(parts[0]):
+            return self._send(404, 'No such branch.')
+        b = repo.branches[parts[0]]
+        if len(parts) == 1:
+            if not isdir: return self._redirect()
+            return self._list_revisions(b)
+        try:
+            num = int(parts[1])
+        except ValueError:
+            return self._send(404, 'No such revision.')
+        if not b.has_revision(num):
+            return self._send(404, 'No such revision.')
+        node = b.revisions[num].root
+        for name in parts[2:]:
+            if not isinstance(node, Directory):
+                return self._send(404, 'No such file.')
+            node = node.dirs.get(name) or node.files.get(name)
+            if node is None:
+                return self._send(404, 'No such file.')
+        if isinstance(node, File):
+            return self._send_file(node)
+        if not isdir: return self._redirect()
+        self._list_dir(b, num, node)
+    
+    def _list_branches(self, repo):
+        items = []
+        for name in sorted(repo.branches):
+            b = repo.branches[name]
+            items.append('<a href="%s/">%s</a> - %s (%d revisions)' \
+                    % (urllib.quote(name), cgi.escape(name),
+                       cgi.escape(b.path), len(b.revisions)))
+        self._send_list('Branches', items)
+    
+    def _list_revisions(self, b):
+        items = []
+        for v in b.revisions:
+            items.append('<a href="%d/">%d</a> %s - %s' \
+                    % (v.num, v.num, _format_time(v.time),
+                       cgi.escape(str(v.desc))))
+        self._send_list('Branch %s' % b.name, items)
+    
+    def _list_dir(self, b, num, dr):
+        items = ['<a href="../">../</a>']
+        for name in sorted(dr.dirs):
+            items.append('<a href="%s/">%s/</a>' \
+                    % (urllib.quote(name), cgi.escape(name)))
+        for name in sorted(dr.files):
+            items.append('<a href="%s">%s</a>' \
+                    % (urllib.quote(name), cgi.escape(name)))
+        self._send_list('Branch %s, revision %d: %s' \
+                % (b.name, num, dr.path()), items)
+    
+    def _send_list(self, title, items):
+        title = cgi.escape(title)
+        page = '<html><head><title>%s</title></head><body><h1>%s</h1>' \
+                '<ul>%s</ul></body></html>' % (title, title, 
+                ''.join(['<li>%s</li>' % item for item in items]))
+        self._send(200, page, 'text/html; charset=utf-8')
+    
+    def _send_file(self, f):
+        etag = '"%s"' % f.etag()
+        headers = {'ETag': etag, 'Accept-Ranges': 'bytes',
+                   'Last-Modified': self.date_time_string(f.mtime)}
+        match = self.headers.get('If-None-Match', '')
+        if etag in match or match.strip() == '*':
+            return self._send(304, None, None, headers)
+        data = f.data
+        ctype = mimetypes.guess_type(f.name)[0] or 'application/octet-stream'
+        try:
+            brange = _parse_range(self.headers.get('Range', ''), len(data))
+        except ValueError:
+            headers['Content-Range'] = 'bytes */%d' % len(data)
+            return self._send(416, 'Requested range not satisfiable.',
+                              'text/plain', headers)
+        if brange is None:
+            return self._send(200, data, ctype, headers)
+        start, end = brange
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(data))
+        self._send(206, data[start:end + 1], ctype, headers)
+    
+    def _redirect(self):
+        self._send(301, None, None, {'Location': self.path.split('?')[0] + '/'})
+    
+    def _send(self, code, data, ctype='text/plain', headers=None):
+        self.send_response(code)
+        for key in headers or {}:
+            self.send_header(key, headers[key])
+        if data is not None:
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(data)))
+        else:
+            self.send_header('Content-Length', '0')
+        self.end_headers()
+        if self.send_body and data is not None:
+            self.wfile.write(data)
+
+def c_serve(args, path):
+    _check_repname()
+    try:
+        opts, rest = getopt.getopt(args, 'p:', ('port=',))
+    except getopt.error, msg:
+        raise Usage(msg)
+    if rest:
+        raise Usage('serve takes only the --port option')
+    port = 8000
+    for option, value in opts:
+        if option in ('-p', '--port'):
+            port = _parse_num(value, 'port')
+    if not 0 < port < 65536:
+        raise Usage('port must be between 1 and 65535')
+    repo = _load_repo(path)
+    try:
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), 
+                                           _RepoRequestHandler)
+    except IOError, e:
+        raise Usage('cannot listen on port %d: %s' % (port, e.strerror))
+    server.repo = repo
+    print 'Serving repository "%s" at http://127.0.0.1:%d/ (Ctrl-C stops).' \
+            % (repname, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print 'Server stopped. Blob cache: %d hit(s), %d miss(es).' \
+                % (blob_cache.hits, blob_cache.misses)
+    server.server_close()
+
+def _parse_policy(text):
+    try:
+        return RetentionPolicy.parse(text)
+    except BadPolicyError, e:
+        raise Usage('bad retention policy "%s"' % e.text)
+
+def c_policy(args, path):
+    _check_repname()
+    if len(args) > 1:
+        raise Usage('provide at most 1 retention policy')
+    repo = _load_repo(path)
+    _check_branchname(repo)
+    b = repo.branches[branchname]
+    if len(args) == 0:
+        if b.policy:
+            print 'Retention policy of branch "%s": %s' % (branchname, b.policy)
+        else:
+            print 'Branch "%s" has no retention policy.' % branchname
+        return
+    if args[0] == 'none':
+        b.policy = None
+        print 'Retention policy of branch "%s" removed.' % branchname
+    else:
+        b.policy = _parse_policy(args[0])
+        print 'Retention policy of branch "%s" set to: %s' \
+                % (branchname, b.policy)
+    _save_repo(repo, path)
+
+def c_prune(args, path):
+    _check_repname()
+    if len(args) > 1:
+        raise Usage('provide at most 1 retention policy')
+    repo = _load_repo(path)
+    _check_branchname(repo)
+    b = repo.branches[branchname]
+    if len(args) > 0:
+        policy = _parse_policy(args[0])
+    elif b.policy:
+        policy = b.policy
+    else:
+        raise Usage('branch "%s" has no retention policy, provide one' \
+                % branchname)
+    removed = b.prune(policy)
+    if removed:
+        _save_repo(repo, path)
+        print '%d revision(s) pruned from branch "%s" (policy: %s).' \
+                % (removed, branchname, policy)
+    else:
+        print 'Nothing to prune.'
+
+def c_squash(args, path):
+    _check_repname()
+    if len(args) != 2:
+        raise Usage('provide the first and the last revision number')
+    first = _parse_num(args[0])
+    last = _parse_num(args[1])
+    repo = _load_repo(path)
+    _check_branchname(repo)
+    b = repo.branches[branchname]
+    count = len(b.revisions)
+    try:
+        v = b.squash(first, last)
+    except NoSuchRevisionError, e:
+        _check_ver(b, e.num)
+    except BadRangeError:
+        raise Usage('the first revision must precede the last one')
+    _save_repo(repo, path)
+    print '%d revision(s) squashed into revision %d of branch "%s".' \
+            % (count - len(b.revisions) + 1, v.num, branchname)
+
+def _prompt_lines():
+    lineno = 0
+    while True:
+        try:
+            line = raw_input('vc> ')
+        except (EOFError, KeyboardInterrupt):
+            print
+            return
+        lineno += 1
+        yield lineno, line
+
+def _run_session(lines, path, interactive):
+    global _session, repname, branchname
+    if _session is not None:
+        raise Usage('sessions cannot be nested')
+    sesrepname = repname
+    sesbranchname = branchname
+    _session = {}
+    status = None
+    try:
+        try:
+            for lineno, line in lines:
+                for entry in _session.values():
+                    entry[2] = False
+                try:
+                    try:
+                        words = shlex.split(line, True)
+                    except ValueError, e:
+                        raise Usage('cannot parse the line: %s' % e)
+                    if not words: continue
+                    if words[0] in ('q', 'quit', 'exit'): break
+                    if words[0] == 'save':
+                        _flush_session()
+                        print 'Session saved.'
+                        continue
+                    repname = sesrepname
+                    branchname = sesbranchname
+                    status = parse_options(words, path)
+                    if status and not interactive:
+                        print >> sys.stderr, 'line %d: failed with status %d' \
+                                % (lineno, status)
+                        break
+                    elif status:
+                        print >> sys.stderr, \
+                                'error: command failed with status %d' % status
+                        status = None
+                except Usage, err:
+                    if not interactive:
+                        raise Usage('line %d: %s' % (lineno, err.msg))
+                    print >> sys.stderr, 'error: %s' % err.msg
+                except:
+                    _discard_touched()
+                    if not interactive: raise
+                    e = sys.exc_info()[1]
+                    ename = e.__class__.__name__
+                    if e.__class__.__module__ != 'exceptions':
+                        ename = '%s.%s' % (e.__class__.__module__, ename)
+                    print >> sys.stderr, 'error: %s: %s' % (ename, e)
+        finally:
+            _flush_session() # keep the work done so far, as single calls do
+    finally:
+        _session = None
+    return status
+
+def c_shell(args, path):
+    if len(args) > 0:
+        raise Usage('shell does not take arguments')
+    _run_session(_prompt_lines(), path, True)
+
+def c_batch(args, path):
+    if len(args) > 1:
+        raise Usage('provide at most 1 script file')
+    if len(args) > 0:
+        try:
+            f = open(args[0], 'r')
+        except IOError, e:
+            raise Usage('cannot read script "%s": %s' % (args[0], e.strerror))
+    else:
+        f = sys.stdin
+    try:
+        return _run_session(enumerate(f, 1), path, False)
+    finally:
+        if f is not sys.stdin: f.close()
+
 def c_help(args): 
     header = '\nVercont V.%s\n%s' % (__version__, __author__)
     help_message = '''
@@ -632,6 +1256,8 @@ OPTIONS:
     -r, --repo          Indicates a repository. May be ommited if there is
                         only one repository in the current directory.
     -b, --branch        Indicates a branch other than the default one.
+    -c, --cache         Size of decompressed files kept in memory, 
+                        e.g. 64M (32M by default). 0 disables the cache.
 
 COMMANDS:
     h, help             Prints this message.
@@ -656,6 +1282,32 @@ COMMANDS:
                         as the second argument.
     def                 Sets the default branch for the repository. 
                         Branch name should be passed as an argument. 
+    policy              Sets the retention policy of the branch given as 
+                        an argument, e.g. "hourly:2d,daily:30d,monthly".
+                        Periods: all, hourly, daily, weekly, monthly, 
+                        yearly; spans: h, d, w, m, y (forever if ommited).
+                        The policy is applied after every commit. 
+                        "none" removes it, no argument prints it.
+    prune               Removes revisions not kept by the retention policy
+                        given as an argument or set on the branch.
+                        Remaining revisions are renumbered.
+    squash              Merges revisions from the first to the last one
+                        given as arguments into a single revision holding
+                        the data of the last one.
+    fsck                Verifies checksums of all stored files. The number
+                        of worker processes may be passed as an argument
+                        (the number of CPUs by default). Exits with 
+                        status 1 if damaged files are found.
+    serve               Serves branches, revisions and files read-only 
+                        over HTTP on 127.0.0.1. Accepts --port N 
+                        (8000 by default).
+    shell               Reads commands interactively, keeping repositories
+                        loaded. Each line holds options and a command as
+                        on the command line. Changes are saved on exit or 
+                        by the "save" command; "quit" ends the session.
+    batch               Runs commands like the shell, but from the script 
+                        file given as an argument or the standard input.
+                        Stops at the first failing line.
     
 EXAMPLES:
     vc.py -r docs new /home/username/documents
@@ -673,6 +1325,12 @@ EXAMPLES:
     vc.py u 0
         - Restores data to the first revision from the default repository 
           and branch.
+    vc.py -r docs batch < script.txt
+        - Runs commands from "script.txt" against the repository "docs"
+          and saves it once at the end.
+    vc.py policy hourly:2d,daily:30d,monthly
+        - Keeps hourly revisions for 2 days, daily ones for 30 days
+          and monthly ones forever in the default branch.
     '''
     print header
     print __license__
@@ -701,6 +1359,20 @@ def parse_commands(args, path):
         c_desc(args[1:], path)
     elif args[0] == 'def':
         c_def(args[1:], path)
+    elif args[0] == 'policy':
+        c_policy(args[1:], path)
+    elif args[0] == 'prune':
+        c_prune(args[1:], path)
+    elif args[0] == 'squash':
+        c_squash(args[1:], path)
+    elif args[0] == 'fsck':
+        return c_fsck(args[1:], path)
+    elif args[0] == 'serve':
+        c_serve(args[1:], path)
+    elif args[0] == 'shell':
+        c_shell(args[1:], path)
+    elif args[0] == 'batch':
+        return c_batch(args[1:], path)
     else:
         if args[0].startswith('-'):
             raise Usage("option unknown")
@@ -709,7 +1381,8 @@ def parse_commands(args, path):
 
 def parse_options(args, path):
     try:
-        opts, commands = getopt.getopt(args, "r:b:", ("repo=", "branch="))
+        opts, commands = getopt.getopt(args, "r:b:c:", 
+                                       ("repo=", "branch=", "cache="))
     except getopt.error, msg:
         raise Usage(msg)
     for option, value in opts:
@@ -719,7 +1392,9 @@ def parse_options(args, path):
         if option in ('-r', '--repo'):
             global repname
             repname = norm_repname(value)
-    parse_commands(commands, path)
+        if option in ('-c', '--cache'):
+            blob_cache.resize(_parse_size(value))
+    return parse_commands(commands, path)
 
 def default_repname(path):
     rname = None
@@ -744,7 +1419,7 @@ def main(argv=None):
     branchname = None
     repname = norm_repname(default_repname(path))
     try:
-        parse_options(argv[1:], path)
+        return parse_options(argv[1:], path)
     except Usage, err:
         sname = sys.argv[0].split('/')[-1]
         print >> sys.stderr,  '%s: %s' % (sname, str(err.msg))